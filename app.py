@@ -1,8 +1,21 @@
+import os
+
+# Keep BLAS/OpenMP pools single-threaded in Gradio's worker threads; must be
+# set before torch/numpy are imported
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 import gradio as gr
+import asyncio
 import boto3
-import json
-import os
-from qdrant_client import QdrantClient
+import onnxruntime as ort
+import orjson
+import threading
+import time
+import numpy as np
+from botocore.config import Config
+from collections import OrderedDict
+from qdrant_client import QdrantClient, models
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
@@ -10,87 +23,344 @@ load_dotenv(dotenv_path=".env")
 os.environ['AWS_ACCESS_KEY_ID'] = os.getenv('AWS_ACCESS_KEY')
 os.environ['AWS_SECRET_ACCESS_KEY'] = os.getenv('AWS_SECRET_ACCESS_KEY')
 
+# Number of chat requests Gradio will run at once
+CONCURRENCY_LIMIT = 16
+
+# Dynamically INT8-quantized ONNX export of the embedder (VNNI int8 GEMMs).
+# Must match the model used in data_ingestion.py.
+EMBED_MODEL = "all-MiniLM-L6-v2"
+EMBED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Explicit ONNX Runtime thread counts for single-query latency; the default
+# pool oversubscribes many-core hosts
+EMBED_THREADS = min(8, os.cpu_count() or 1)
+
 # ================================================================
 # LOAD MODELS
 # ================================================================
 print("Loading models...")
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
-qdrant = QdrantClient(url="http://localhost:6333")
+session_options = ort.SessionOptions()
+session_options.intra_op_num_threads = EMBED_THREADS
+session_options.inter_op_num_threads = 1
+
+embedder = SentenceTransformer(
+    EMBED_MODEL,
+    backend="onnx",
+    model_kwargs={"file_name": EMBED_ONNX_FILE, "session_options": session_options}
+)
+qdrant = QdrantClient(
+    host="localhost",
+    grpc_port=6334,
+    prefer_grpc=True,
+    timeout=5,
+    grpc_options={"grpc.keepalive_time_ms": 10000}
+)
 bedrock = boto3.client(
     service_name="bedrock-runtime",
-    region_name="ap-southeast-2"
+    region_name="ap-southeast-2",
+    config=Config(
+        retries={"max_attempts": 3, "mode": "standard"},
+        max_pool_connections=CONCURRENCY_LIMIT
+    )
 )
 COLLECTION = "metricon_rag"
+# Search the int8-quantized index, then rescore 2x top_k candidates with the
+# original FP32 vectors to preserve recall
+SEARCH_PARAMS = models.SearchParams(
+    quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+# Only the payload fields rag_answer reads are sent back by Qdrant
+PAYLOAD_FIELDS = models.PayloadSelectorInclude(include=["ctx", "display"])
 print("✅ Models loaded!")
 
 # ================================================================
-# RAG FUNCTION
+# WARM UP
 # ================================================================
-def rag_answer(question, history, top_k, show_sources):
+# Pay for ONNX session init, thread-pool start-up and the first Bedrock TLS
+# handshake now rather than on the first user's request
+def warm_up_bedrock():
+    # Runs on a background thread so an unreachable Bedrock (retries + 60 s
+    # timeouts) never delays startup; it still primes the shared client's pool
     try:
-        query_vec = embedder.encode(question).tolist()
-        results = qdrant.query_points(
-            collection_name=COLLECTION,
-            query=query_vec,
-            limit=int(top_k)
-        )
+        bedrock.invoke_model(
+            modelId="amazon.nova-micro-v1:0",
+            body=orjson.dumps({
+                "messages": [{"role": "user", "content": [{"text": "Hi"}]}],
+                "inferenceConfig": {"maxTokens": 1}
+            })
+        )["body"].read()
+        print("✅ Bedrock warm-up complete!")
+    except Exception as e:
+        print(f"⚠️ Bedrock warm-up failed: {e}")
 
-        if not results.points:
-            history.append({"role": "user", "content": question})
-            history.append({"role": "assistant", "content": "⚠️ No relevant information found. Please contact Metricon on 1300 786 773."})
-            return history, ""
-
-        context_chunks = []
-        sources = []
-        for p in results.points:
-            context_chunks.append(
-                f"[{p.payload['category']}] {p.payload['title']}\n{p.payload['text']}"
-            )
-            sources.append(
-                f"📄 **{p.payload['title']}**\n"
-                f"📂 {p.payload['source']} | 🏷️ {p.payload['category']} | ⭐ {p.payload['importance']}/10"
+print("Warming up...")
+threading.Thread(target=warm_up_bedrock, daemon=True).start()
+embedder.encode(["warmup"] * 2, convert_to_numpy=True)
+print("✅ Embedder warm-up complete!")
+
+def embed_query(question):
+    return embedder.encode(question, convert_to_numpy=True, normalize_embeddings=True)
+
+# ================================================================
+# QUERY CACHE
+# ================================================================
+# Repeat questions (e.g. the quick-question buttons) hit on the normalized
+# text; near-repeats hit on cosine similarity against cached query vectors.
+# Either way Qdrant and Bedrock are skipped.
+QCACHE_MAX_SIZE = 512
+QCACHE_TTL = 600
+QCACHE_SIMILARITY = 0.97
+
+# data_ingestion.py rewrites this marker after every re-ingest; a changed
+# mtime drops all cached answers. Must match the path used there.
+COLLECTION_VERSION_PATH = "chunker/collection.version"
+
+_QCACHE = OrderedDict()
+_QCACHE_LOCK = threading.RLock()
+_collection_version = 0
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+def sync_collection_version():
+    global _collection_version
+    try:
+        version = os.stat(COLLECTION_VERSION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        version = 0
+    with _QCACHE_LOCK:
+        if version != _collection_version:
+            _collection_version = version
+            _QCACHE.clear()
+        return version
+
+def cache_get(key):
+    with _QCACHE_LOCK:
+        entry = _QCACHE.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[3] > QCACHE_TTL:
+            del _QCACHE[key]
+            return None
+        _QCACHE.move_to_end(key)
+        return entry
+
+def cache_get_similar(version, top_k, query_vec):
+    with _QCACHE_LOCK:
+        now = time.time()
+        keys = [
+            k for k, entry in _QCACHE.items()
+            if k[0] == version and k[1] == top_k and now - entry[3] <= QCACHE_TTL
+        ]
+        if not keys:
+            return None
+        cached_mat = np.stack([_QCACHE[k][0] for k in keys])
+        # Query vectors are unit-normalized by the encoder, so dot == cosine
+        scores = cached_mat @ query_vec
+        best = int(np.argmax(scores))
+        if scores[best] < QCACHE_SIMILARITY:
+            return None
+        _QCACHE.move_to_end(keys[best])
+        return _QCACHE[keys[best]]
+
+def cache_put(key, query_vec, sources, answer):
+    with _QCACHE_LOCK:
+        if key[0] != _collection_version:
+            return
+        _QCACHE[key] = (query_vec, sources, answer, time.time())
+        _QCACHE.move_to_end(key)
+        while len(_QCACHE) > QCACHE_MAX_SIZE:
+            _QCACHE.popitem(last=False)
+
+# ================================================================
+# QDRANT QUERY BATCHER
+# ================================================================
+# Queries arriving within a 5 ms window (or up to 16 of them) are sent to
+# Qdrant as one query_batch_points call and the results fanned back out.
+# Each batch is dispatched as its own task so a slow round trip never holds
+# up the next batch.
+BATCH_WINDOW = 0.005
+BATCH_MAX_SIZE = 16
+# Upper bound on a caller's wait; above the 5 s gRPC timeout
+QUERY_TIMEOUT = 10
+
+class QueryBatcher:
+    def __init__(self):
+        self.queue = None
+        self.worker = None
+        self.inflight = set()
+
+    async def query(self, query_vec, limit):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query_vec, limit, future))
+        return await asyncio.wait_for(future, QUERY_TIMEOUT)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_MAX_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self.dispatch(batch))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def dispatch(self, batch):
+        try:
+            requests = [
+                # QueryRequest only validates plain float lists, so the
+                # numpy vector is converted here, once, at the client boundary
+                models.QueryRequest(
+                    query=query_vec.tolist(),
+                    limit=limit,
+                    params=SEARCH_PARAMS,
+                    with_payload=PAYLOAD_FIELDS,
+                    with_vector=False
+                )
+                for query_vec, limit, _ in batch
+            ]
+            responses = await asyncio.to_thread(
+                qdrant.query_batch_points,
+                collection_name=COLLECTION,
+                requests=requests
             )
+            if len(responses) != len(batch):
+                raise RuntimeError(f"Qdrant returned {len(responses)} results for {len(batch)} queries")
+
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
 
-        context = "\n\n".join(context_chunks)
+query_batcher = QueryBatcher()
 
-        prompt = f"""
+# ================================================================
+# PROMPT
+# ================================================================
+PROMPT_HEAD = """
 You are a friendly and professional AI assistant for Metricon Homes Australia.
 Answer the customer's question using ONLY the provided context.
 Be warm, helpful and concise. Use dot points where appropriate.
 If the answer is not in the context, say "I don't have that information. Please contact Metricon on 1300 786 773 or visit metricon.com.au"
 
 CONTEXT:
-{context}
+"""
+PROMPT_MID = "\n\nQUESTION:\n"
+PROMPT_TAIL = "\n\nANSWER:\n"
 
-QUESTION:
-{question}
+# The Bedrock request body with the static prompt text pre-escaped, so each
+# request only has to JSON-escape the context and question
+_BODY_HEAD = b'{"messages":[{"role":"user","content":[{"text":' + orjson.dumps(PROMPT_HEAD)[:-1]
+_BODY_MID = orjson.dumps(PROMPT_MID)[1:-1]
+_BODY_TAIL = (
+    orjson.dumps(PROMPT_TAIL)[1:]
+    + b'}]}],"inferenceConfig":'
+    + orjson.dumps({"maxTokens": 400, "temperature": 0.2})
+    + b"}"
+)
 
-ANSWER:
-"""
-        response = bedrock.invoke_model(
-            modelId="amazon.nova-micro-v1:0",
-            body=json.dumps({
-                "messages": [{"role": "user", "content": [{"text": prompt}]}],
-                "inferenceConfig": {"maxTokens": 400, "temperature": 0.2}
-            })
-        )
-        output = json.loads(response["body"].read())
-        answer = output["output"]["message"]["content"][0]["text"]
+def build_request_body(context, question):
+    return b"".join((
+        _BODY_HEAD,
+        orjson.dumps(context)[1:-1],
+        _BODY_MID,
+        orjson.dumps(question)[1:-1],
+        _BODY_TAIL
+    ))
 
-        history.append({"role": "user", "content": question})
-        history.append({"role": "assistant", "content": answer})
+# ================================================================
+# RAG FUNCTION
+# ================================================================
+async def rag_answer(question, history, top_k, show_sources):
+    # Async generator: yields (history, sources_text) as answer tokens arrive
+    history.append({"role": "user", "content": question})
+    reply = {"role": "assistant", "content": ""}
+    history.append(reply)
+
+    try:
+        top_k = int(top_k)
+        version = sync_collection_version()
+        key = (version, top_k, normalize_question(question))
+
+        cached = cache_get(key)
+        if cached is None:
+            query_vec = await asyncio.to_thread(embed_query, question)
+            cached = cache_get_similar(version, top_k, query_vec)
+
+        if cached is not None:
+            _, sources, answer, _ = cached
+            reply["content"] = answer
+            yield history, "\n\n".join(sources) if show_sources else ""
+            return
+
+        results = await query_batcher.query(query_vec, top_k)
 
+        if not results.points:
+            reply["content"] = "⚠️ No relevant information found. Please contact Metricon on 1300 786 773."
+            yield history, ""
+            return
+
+        # ctx/display are pre-formatted at ingest time (see data_ingestion.py)
+        context = "\n\n".join(p.payload["ctx"] for p in results.points)
+        sources = [p.payload["display"] for p in results.points]
         sources_text = "\n\n".join(sources) if show_sources else ""
-        return history, sources_text
+
+        response = await asyncio.to_thread(
+            bedrock.invoke_model_with_response_stream,
+            modelId="amazon.nova-micro-v1:0",
+            body=build_request_body(context, question)
+        )
+        # Closed in finally so a cancelled/disconnected generator returns the
+        # connection to the pool instead of holding it until the stream ends
+        try:
+            events = iter(response["body"])
+            while (event := await asyncio.to_thread(next, events, None)) is not None:
+                if "chunk" not in event:
+                    continue
+                chunk = orjson.loads(event["chunk"]["bytes"])
+                delta = chunk.get("contentBlockDelta", {}).get("delta", {}).get("text")
+                if delta:
+                    reply["content"] += delta
+                    yield history, sources_text
+        finally:
+            response["body"].close()
+
+        if reply["content"]:
+            cache_put(key, query_vec, sources, reply["content"])
+        yield history, sources_text
 
     except Exception as e:
-        history.append({"role": "user", "content": question})
-        history.append({"role": "assistant", "content": f"❌ Error: {str(e)}"})
-        return history, ""
+        reply["content"] = f"❌ Error: {str(e)}"
+        yield history, ""
 
 # ================================================================
 # GRADIO UI
 # ================================================================
+QUICK_QUESTIONS = [
+    "What is the building process at Metricon?",
+    "What are the costs involved in building?",
+    "Why should I choose Metricon?",
+    "What options are available for first home buyers?",
+    "How long does it take to build a Metricon home?",
+    "What finance options are available?"
+]
+
 with gr.Blocks() as demo:
 
     gr.HTML("""
@@ -163,35 +433,40 @@ with gr.Blocks() as demo:
     # ================================================================
     # EVENT HANDLERS
     # ================================================================
-    def respond(message, history, top_k, show_sources):
-        return rag_answer(message, history, top_k, show_sources)
+    async def respond(message, history, top_k, show_sources):
+        async for update in rag_answer(message, history, top_k, show_sources):
+            yield update
 
     def clear():
         return [], ""
 
-    def set_question(q, history, top_k, show_sources):
-        return rag_answer(q, history, top_k, show_sources)
-
     send_btn.click(
         respond,
         inputs=[msg, chatbot, top_k, show_sources],
-        outputs=[chatbot, sources_box]
+        outputs=[chatbot, sources_box],
+        concurrency_limit=CONCURRENCY_LIMIT
     ).then(lambda: "", outputs=msg)
 
     msg.submit(
         respond,
         inputs=[msg, chatbot, top_k, show_sources],
-        outputs=[chatbot, sources_box]
+        outputs=[chatbot, sources_box],
+        concurrency_limit=CONCURRENCY_LIMIT
     ).then(lambda: "", outputs=msg)
 
-    clear_btn.click(clear, outputs=[chatbot, sources_box])
+    clear_btn.click(clear, outputs=[chatbot, sources_box], concurrency_limit=CONCURRENCY_LIMIT)
 
-    btn1.click(lambda h, k, s: set_question("What is the building process at Metricon?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
-    btn2.click(lambda h, k, s: set_question("What are the costs involved in building?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
-    btn3.click(lambda h, k, s: set_question("Why should I choose Metricon?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
-    btn4.click(lambda h, k, s: set_question("What options are available for first home buyers?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
-    btn5.click(lambda h, k, s: set_question("How long does it take to build a Metricon home?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
-    btn6.click(lambda h, k, s: set_question("What finance options are available?", h, k, s), inputs=[chatbot, top_k, show_sources], outputs=[chatbot, sources_box])
+    # Quick questions fill the textbox client-side, then go through the same
+    # respond path as a typed question (and so hit the query cache)
+    for btn, question in zip([btn1, btn2, btn3, btn4, btn5, btn6], QUICK_QUESTIONS):
+        btn.click(
+            None, None, msg, js=f"() => {orjson.dumps(question).decode()}"
+        ).then(
+            respond,
+            inputs=[msg, chatbot, top_k, show_sources],
+            outputs=[chatbot, sources_box],
+            concurrency_limit=CONCURRENCY_LIMIT
+        ).then(lambda: "", outputs=msg)
 
 # ================================================================
 # LAUNCH
@@ -1,7 +1,11 @@
+import numpy as np
 import os
-import json
+import orjson
 import boto3
+import threading
 import time
+from botocore.config import Config
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pypdf import PdfReader
 from dotenv import load_dotenv
 
@@ -15,49 +19,117 @@ os.environ['AWS_SECRET_ACCESS_KEY'] = os.getenv('AWS_SECRET_ACCESS_KEY')
 # ================================================================
 # AWS BEDROCK CLIENT
 # ================================================================
+MODEL_ID = "amazon.nova-micro-v1:0"
+ENRICH_WORKERS = 10
+ENRICH_RATE = 20  # Bedrock requests per second
+
 bedrock = boto3.client(
     service_name="bedrock-runtime",
-    region_name="ap-southeast-2"
+    region_name="ap-southeast-2",
+    config=Config(
+        retries={"max_attempts": 5, "mode": "standard"},
+        max_pool_connections=ENRICH_WORKERS
+    )
 )
 
+# ================================================================
+# RATE LIMITER (token bucket shared by all enrichment workers)
+# ================================================================
+class RateLimiter:
+    def __init__(self, rate, per=1.0):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+rate_limiter = RateLimiter(ENRICH_RATE)
+
+# ================================================================
+# AWS BEDROCK BATCH INFERENCE (optional, ~50% cheaper for offline runs)
+# ================================================================
+# Enabled when a bucket and service role are configured. Bedrock rejects
+# batch jobs below a minimum record count, so small corpora fall back to
+# the real-time path.
+BATCH_BUCKET = os.getenv("BEDROCK_BATCH_BUCKET")
+BATCH_ROLE_ARN = os.getenv("BEDROCK_BATCH_ROLE_ARN")
+BATCH_S3_PREFIX = "metricon-enrichment"
+BATCH_MIN_RECORDS = 100
+BATCH_POLL_SECONDS = 30
+BATCH_MAX_WAIT_SECONDS = 12 * 60 * 60  # then stop the job and go real-time
+
+bedrock_batch = boto3.client(service_name="bedrock", region_name="ap-southeast-2")
+s3 = boto3.client(service_name="s3", region_name="ap-southeast-2")
+
 # ================================================================
 # 1. LOAD PDFs
 # ================================================================
+def _load_one_pdf(filepath):
+    reader = PdfReader(filepath)
+    text = "".join(page.extract_text() or "" for page in reader.pages)
+    return {
+        "source": os.path.basename(filepath),
+        "text": text.strip()
+    }
+
 def load_pdfs(data_folder="data"):
+    # Text extraction is CPU-bound and PDFs are independent, so parse them
+    # in separate processes
+    pdf_paths = [
+        os.path.join(data_folder, filename)
+        for filename in os.listdir(data_folder)
+        if filename.endswith(".pdf")
+    ]
+    if not pdf_paths:
+        return []
+
     documents = []
-    for filename in os.listdir(data_folder):
-        if filename.endswith(".pdf"):
-            filepath = os.path.join(data_folder, filename)
-            reader = PdfReader(filepath)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-            documents.append({
-                "source": filename,
-                "text": text.strip()
-            })
-            print(f"✅ Loaded: {filename}")
+    with ProcessPoolExecutor(max_workers=min(len(pdf_paths), os.cpu_count() or 1)) as executor:
+        for document in executor.map(_load_one_pdf, pdf_paths):
+            documents.append(document)
+            print(f"✅ Loaded: {document['source']}")
     return documents
 
 # ================================================================
 # 2. SPLIT TEXT INTO RAW CHUNKS
 # ================================================================
 def split_text(text, chunk_size=400, overlap=50):
+    # Join the words once, then cut each window out as a single slice using
+    # the words' character offsets instead of re-joining every window
     words = text.split()
+    if not words:
+        return []
+    joined = " ".join(words)
+
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    word_ends = np.cumsum(lengths + 1) - 1
+    word_starts = word_ends - lengths
+
+    window_starts = np.arange(0, len(words), chunk_size - overlap)
+    window_ends = np.minimum(window_starts + chunk_size, len(words)) - 1
+
     chunks = []
-    start = 0
-    while start < len(words):
-        end = start + chunk_size
-        chunk = " ".join(words[start:end])
-        if len(chunk.strip()) > 50:
-            chunks.append(chunk)
-        start += chunk_size - overlap
+    for start, end in zip(word_starts[window_starts].tolist(), word_ends[window_ends].tolist()):
+        if end - start > 50:
+            chunks.append(joined[start:end])
     return chunks
 
 # ================================================================
 # 3. ENRICH EACH CHUNK USING BEDROCK NOVA
 # ================================================================
-def enrich_chunk(chunk_text, source):
+def build_enrich_input(chunk_text):
     prompt = f"""
 You are an intelligent document analyst for Metricon Homes.
 Analyze the following text chunk and return a JSON object with these exact fields:
@@ -72,73 +144,150 @@ Text chunk:
 
 Respond ONLY with a valid JSON object. No explanation, no markdown, no extra text.
 """
+    return {
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"text": prompt}]
+            }
+        ],
+        "inferenceConfig": {
+            "maxTokens": 300,
+            "temperature": 0.2
+        }
+    }
+
+def default_enrichment(chunk_text):
+    return {
+        "title": "General Information",
+        "summary": chunk_text[:100],
+        "keywords": [],
+        "category": "General",
+        "importance": 5
+    }
+
+def parse_enrichment(output):
+    raw = output["output"]["message"]["content"][0]["text"]
+    raw = raw.strip().replace("```json", "").replace("```", "").strip()
+    return orjson.loads(raw)
+
+def enrich_chunk(chunk_text, source):
     try:
+        rate_limiter.acquire()
         response = bedrock.invoke_model(
-            modelId="amazon.nova-micro-v1:0",
-            body=json.dumps({
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [{"text": prompt}]
-                    }
-                ],
-                "inferenceConfig": {
-                    "maxTokens": 300,
-                    "temperature": 0.2
-                }
-            })
+            modelId=MODEL_ID,
+            body=orjson.dumps(build_enrich_input(chunk_text))
         )
-        output = json.loads(response["body"].read())
-        raw = output["output"]["message"]["content"][0]["text"]
-        raw = raw.strip().replace("```json", "").replace("```", "").strip()
-        enriched = json.loads(raw)
-        return enriched
+        output = orjson.loads(response["body"].read())
+        return parse_enrichment(output)
 
     except Exception as e:
         print(f"⚠️ Enrichment failed: {e}")
-        return {
-            "title": "General Information",
-            "summary": chunk_text[:100],
-            "keywords": [],
-            "category": "General",
-            "importance": 5
-        }
+        return default_enrichment(chunk_text)
+
+# ================================================================
+# 3b. ENRICH ALL CHUNKS WITH ONE BEDROCK BATCH INFERENCE JOB
+# ================================================================
+def enrich_chunks_batch(raw_chunks):
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    prefix = f"{BATCH_S3_PREFIX}/{run_id}"
+    input_key = f"{prefix}/input/chunks.jsonl"
+    output_uri = f"s3://{BATCH_BUCKET}/{prefix}/output/"
+
+    records = [
+        orjson.dumps({"recordId": f"{i:011d}", "modelInput": build_enrich_input(chunk)})
+        for i, (_, chunk) in enumerate(raw_chunks)
+    ]
+    s3.put_object(Bucket=BATCH_BUCKET, Key=input_key, Body=b"\n".join(records))
+
+    job = bedrock_batch.create_model_invocation_job(
+        jobName=f"metricon-enrich-{run_id}",
+        roleArn=BATCH_ROLE_ARN,
+        modelId=MODEL_ID,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{BATCH_BUCKET}/{input_key}"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": output_uri}}
+    )
+    job_arn = job["jobArn"]
+    print(f"   📨 Submitted batch job: {job_arn}")
+
+    deadline = time.monotonic() + BATCH_MAX_WAIT_SECONDS
+    while True:
+        status = bedrock_batch.get_model_invocation_job(jobIdentifier=job_arn)["status"]
+        if status in ("Completed", "PartiallyCompleted"):
+            break
+        if status in ("Failed", "Stopped", "Expired"):
+            raise RuntimeError(f"Batch job {job_arn} ended with status {status}")
+        if time.monotonic() > deadline:
+            try:
+                bedrock_batch.stop_model_invocation_job(jobIdentifier=job_arn)
+            except Exception as e:
+                print(f"⚠️ Could not stop batch job: {e}")
+            raise TimeoutError(f"Batch job {job_arn} still {status} after {BATCH_MAX_WAIT_SECONDS}s")
+        print(f"   ⏳ Batch job status: {status}")
+        time.sleep(BATCH_POLL_SECONDS)
+
+    job_id = job_arn.split("/")[-1]
+    output_key = f"{prefix}/output/{job_id}/chunks.jsonl.out"
+    body = s3.get_object(Bucket=BATCH_BUCKET, Key=output_key)["Body"].read()
+
+    outputs = {}
+    for line in body.splitlines():
+        if line.strip():
+            record = orjson.loads(line)
+            outputs[record["recordId"]] = record.get("modelOutput")
+
+    enriched_chunks = []
+    for i, (_, chunk) in enumerate(raw_chunks):
+        try:
+            enriched_chunks.append(parse_enrichment(outputs[f"{i:011d}"]))
+        except Exception as e:
+            print(f"⚠️ Enrichment failed for record {i}: {e}")
+            enriched_chunks.append(default_enrichment(chunk))
+    return enriched_chunks
 
 # ================================================================
 # 4. FULL AGENTIC CHUNKING PIPELINE
 # ================================================================
 def agentic_chunking_pipeline(data_folder="data"):
     documents = load_pdfs(data_folder)
-    all_chunks = []
-    chunk_id = 0
+    raw_chunks = []
 
     for doc in documents:
         print(f"\n📄 Processing: {doc['source']}")
-        raw_chunks = split_text(doc["text"])
-        print(f"   → {len(raw_chunks)} raw chunks found")
-
-        for i, chunk in enumerate(raw_chunks):
-            print(f"   🧠 Enriching chunk {i+1}/{len(raw_chunks)}...")
-            enriched = enrich_chunk(chunk, doc["source"])
-
-            all_chunks.append({
-                "id": chunk_id,
-                "source": doc["source"],
-                "text": chunk,
-                "title": enriched.get("title", ""),
-                "summary": enriched.get("summary", ""),
-                "keywords": enriched.get("keywords", []),
-                "category": enriched.get("category", "General"),
-                "importance": enriched.get("importance", 5)
-            })
-
-            chunk_id += 1
-            time.sleep(0.5)
+        doc_chunks = split_text(doc["text"])
+        print(f"   → {len(doc_chunks)} raw chunks found")
+        raw_chunks.extend((doc["source"], chunk) for chunk in doc_chunks)
+
+    enriched_chunks = None
+    if BATCH_BUCKET and BATCH_ROLE_ARN and len(raw_chunks) >= BATCH_MIN_RECORDS:
+        print(f"\n🧠 Enriching {len(raw_chunks)} chunks with a Bedrock batch job...")
+        try:
+            enriched_chunks = enrich_chunks_batch(raw_chunks)
+        except Exception as e:
+            print(f"⚠️ Batch enrichment failed, falling back to real-time: {e}")
+
+    if enriched_chunks is None:
+        print(f"\n🧠 Enriching {len(raw_chunks)} chunks ({ENRICH_WORKERS} workers)...")
+        with ThreadPoolExecutor(max_workers=ENRICH_WORKERS) as executor:
+            enriched_chunks = list(executor.map(lambda c: enrich_chunk(c[1], c[0]), raw_chunks))
+
+    all_chunks = []
+    for chunk_id, ((source, chunk), enriched) in enumerate(zip(raw_chunks, enriched_chunks)):
+        all_chunks.append({
+            "id": chunk_id,
+            "source": source,
+            "text": chunk,
+            "title": enriched.get("title", ""),
+            "summary": enriched.get("summary", ""),
+            "keywords": enriched.get("keywords", []),
+            "category": enriched.get("category", "General"),
+            "importance": enriched.get("importance", 5)
+        })
 
     # Save to JSON
     output_path = "chunker/chunks.json"
-    with open(output_path, "w") as f:
-        json.dump(all_chunks, f, indent=2)
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(all_chunks, option=orjson.OPT_INDENT_2))
 
     print(f"\n✅ Done! {len(all_chunks)} enriched chunks saved to {output_path}")
     return all_chunks
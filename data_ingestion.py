@@ -1,7 +1,13 @@
-import json
+import hashlib
+import numpy as np
+import orjson
 import os
+import time
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import (
+    VectorParams, Distance, PointStruct,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType
+)
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
@@ -10,15 +16,26 @@ load_dotenv(dotenv_path=".env")
 # ================================================================
 # LOAD EMBEDDING MODEL
 # ================================================================
+# Dynamically INT8-quantized ONNX export of the embedder (VNNI int8 GEMMs).
+# Must match the model used in app.py.
+EMBED_MODEL = "all-MiniLM-L6-v2"
+EMBED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
 print("Loading embedding model...")
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+embedder = SentenceTransformer(
+    EMBED_MODEL,
+    backend="onnx",
+    model_kwargs={"file_name": EMBED_ONNX_FILE}
+)
 print("✅ Embedding model loaded!")
 
 # ================================================================
 # CONNECT TO QDRANT
 # ================================================================
-qdrant = QdrantClient(url="http://localhost:6333")
+qdrant = QdrantClient(host="localhost", grpc_port=6334, prefer_grpc=True)
 COLLECTION = "metricon_rag"
+# Touched after every ingest; app.py clears its query cache when it changes
+COLLECTION_VERSION_PATH = "chunker/collection.version"
 
 # ================================================================
 # CREATE COLLECTION
@@ -31,24 +48,90 @@ def create_collection():
 
     qdrant.create_collection(
         collection_name=COLLECTION,
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE)
+        # Embeddings are unit-normalized at encode time (here and in app.py),
+        # so DOT ranks identically to cosine without the per-candidate norms
+        vectors_config=VectorParams(size=384, distance=Distance.DOT),
+        # int8 copies of the vectors (4x smaller) kept in RAM for the ANN
+        # search; originals are used to rescore the shortlist at query time
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
     )
     print(f"✅ Created collection: {COLLECTION}")
 
+# ================================================================
+# EMBEDDING CACHE
+# ================================================================
+# Vectors are persisted next to chunks.json, keyed by a content hash of the
+# embedded text, so re-ingestion only embeds new or modified chunks.
+EMBEDDINGS_PATH = "chunker/embeddings.npy"
+HASHES_PATH = "chunker/hashes.json"
+EMBED_ONNX_ID = f"{EMBED_MODEL}/{EMBED_ONNX_FILE}"
+
+def embed_text(chunk):
+    return f"{chunk['title']} {chunk['summary']} {chunk['text']}"
+
+def chunk_hash(chunk):
+    return hashlib.sha256(embed_text(chunk).encode()).hexdigest()
+
+def embed_chunks(chunks):
+    # Always hashed from the current content so edited chunks are re-embedded
+    hashes = [chunk_hash(c) for c in chunks]
+
+    cached_hashes = []
+    cached = None
+    if os.path.exists(EMBEDDINGS_PATH) and os.path.exists(HASHES_PATH):
+        with open(HASHES_PATH, "rb") as f:
+            meta = orjson.loads(f.read())
+        if meta.get("model") == EMBED_ONNX_ID:
+            cached_hashes = meta["hashes"]
+            cached = np.load(EMBEDDINGS_PATH, mmap_mode="r")
+
+    if cached is not None and hashes == cached_hashes:
+        print(f"♻️ Reusing all {len(chunks)} cached embeddings")
+        return cached
+
+    cached_rows = {h: i for i, h in enumerate(cached_hashes)}
+    missing = [i for i, h in enumerate(hashes) if h not in cached_rows]
+    print(f"♻️ Reusing {len(chunks) - len(missing)} cached embeddings, embedding {len(missing)} chunks...")
+
+    vectors = np.empty((len(chunks), embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        if h in cached_rows:
+            vectors[i] = cached[cached_rows[h]]
+    del cached
+
+    if missing:
+        vectors[missing] = embedder.encode(
+            [embed_text(chunks[i]) for i in missing],
+            batch_size=64,
+            show_progress_bar=True,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+
+    np.save(EMBEDDINGS_PATH, vectors)
+    with open(HASHES_PATH, "wb") as f:
+        f.write(orjson.dumps({"model": EMBED_ONNX_ID, "hashes": hashes}))
+    return vectors
+
 # ================================================================
 # INGEST CHUNKS
 # ================================================================
 def ingest_chunks():
-    with open("chunker/chunks.json", "r") as f:
-        chunks = json.load(f)
+    with open("chunker/chunks.json", "rb") as f:
+        chunks = orjson.loads(f.read())
 
     print(f"📦 Ingesting {len(chunks)} chunks into Qdrant...")
 
-    points = []
-    for chunk in chunks:
-        text_to_embed = f"{chunk['title']} {chunk['summary']} {chunk['text']}"
-        vector = embedder.encode(text_to_embed).tolist()
+    vectors = embed_chunks(chunks)
 
+    points = []
+    for chunk, vector in zip(chunks, np.asarray(vectors, dtype=np.float32).tolist()):
         points.append(PointStruct(
             id=chunk["id"],
             vector=vector,
@@ -59,11 +142,20 @@ def ingest_chunks():
                 "keywords": chunk["keywords"],
                 "category": chunk["category"],
                 "importance": chunk["importance"],
-                "source": chunk["source"]
+                "source": chunk["source"],
+                "ctx": f"[{chunk['category']}] {chunk['title']}\n{chunk['text']}",
+                "display": (
+                    f"📄 **{chunk['title']}**\n"
+                    f"📂 {chunk['source']} | 🏷️ {chunk['category']} | ⭐ {chunk['importance']}/10"
+                )
             }
         ))
 
     qdrant.upsert(collection_name=COLLECTION, points=points)
+
+    # Signal running app.py processes to drop their cached answers
+    with open(COLLECTION_VERSION_PATH, "w") as f:
+        f.write(f"{time.time_ns()}\n")
     print(f"✅ Successfully ingested {len(points)} chunks!")
 
 # ================================================================